@@ -4,7 +4,47 @@ from pathlib import Path
 from loguru import logger
 from concurrent.futures import ProcessPoolExecutor
 from time import perf_counter
+from typing import NamedTuple
+import bisect
 import os
+import shutil
+
+
+_HEADER_REMOVE_KEYS = frozenset({
+    'image:crop', 'image:window', 'renderMemory', 'renderTime', 'space:world',
+    'worldToCamera', 'worldToNDC',
+    'order'
+})
+
+# set in each separation process by EXRSequence.init_worker
+_worker_context = None
+
+_LABEL_ORDER = {
+    'r': 0, 'g': 1, 'b': 2, 'a': 3,
+    'x': 0, 'y': 1, 'z': 2, 'w': 3
+}
+
+
+# immutable result of a parsed EXRChannelInfo, only plain values for the workers
+class EXRChannelSpec(NamedTuple):
+    name: str
+    pixel_type: int
+    labels: tuple
+    target_channels: tuple
+    is_color: bool
+
+    def get_pixels_data(self, labels_data: {str: bytes}) -> dict:
+        # depth has a single label mapped to R
+        return {
+            target_channel: labels_data[label]
+            for target_channel, label in zip(self.target_channels, self.labels)
+        }
+
+
+# sequence state the separation workers need, shared by every frame
+class EXRSeparateContext(NamedTuple):
+    channel_specs: dict
+    header_channels: dict
 
 
 class EXRChannelInfo:
@@ -12,6 +52,7 @@ class EXRChannelInfo:
         self._name: str = channel_name
         self._type: Imath.Channel = channel_type
         self._labels: [str] = []
+        self._label_orders: [int] = []
 
     def get_name(self):
         return self._name
@@ -30,16 +71,14 @@ class EXRChannelInfo:
 
     @staticmethod
     def compare_labels(element: str):
-        ele = element[-1].lower()
-        compare_values = {
-            'r': 0, 'g': 1, 'b': 2, 'a': 3,
-            'x': 0, 'y': 1, 'z': 2, 'w': 3
-        }
-        return compare_values[ele]
+        return _LABEL_ORDER[element[-1].lower()]
 
     def add_label(self, label):
-        self._labels.append(label)
-        self._labels.sort(key=self.compare_labels)
+        # keep labels sorted by inserting at the right position instead of re-sorting
+        label_order = self.compare_labels(label)
+        index = bisect.bisect(self._label_orders, label_order)
+        self._label_orders.insert(index, label_order)
+        self._labels.insert(index, label)
 
     def is_color(self):
         return self.get_name() == 'C'
@@ -47,6 +86,12 @@ class EXRChannelInfo:
     def is_depth(self):
         return self.get_name() == 'Z'
 
+    def finalize(self) -> EXRChannelSpec:
+        return EXRChannelSpec(
+            self.get_name(), self.get_pixel_type().v, tuple(self.get_labels()), tuple(self.get_target_channels()),
+            self.is_color()
+        )
+
     def is_valid(self):
         label_count = len(self.get_labels())
         if self.is_depth():
@@ -55,15 +100,6 @@ class EXRChannelInfo:
             return False
         return label_count in (3, 4)
 
-    def get_pixels_data(self, exr: OpenEXR.InputFile) -> dict:
-        pixels_data = {}
-        for i, target_channel in enumerate(self.get_target_channels()):
-            label_index = i
-            if self.is_depth():
-                label_index = 0
-            pixels_data[target_channel] = exr.channel(self.get_labels()[label_index], self.get_pixel_type())
-        return pixels_data
-
     def __repr__(self):
         return f'EXR ChannelInfo [{self.get_name()}] - type: {self.get_type()} labels: {self.get_labels()}'
 
@@ -72,12 +108,15 @@ class EXRSequence:
     color_channel_labels = ('R', 'G', 'B', 'A')
     depth_channel_labels = ('Z', )
 
-    def __init__(self, folder_path: Path):
+    def __init__(self, folder_path: Path, channel_whitelist: [str] = None):
         logger.info(f'Create from "{folder_path}"')
         self._folder_path: Path = folder_path
+        self._channel_whitelist: [str] = channel_whitelist
         self._exr_files: [Path] = self._get_files()
         self._header: dict = self._get_header()
         self._channels_info: {str: EXRChannelInfo} = self._get_channels_info()
+        self._channel_specs: {str: EXRChannelSpec} = self._get_channel_specs()
+        self._header_channels: {str: dict} = self._get_header_channels()
 
     def _get_files(self) -> [Path]:
         exr_files = list(self._folder_path.glob('*.exr'))
@@ -126,31 +165,55 @@ class EXRSequence:
         for to_remove_channel_name in to_remove_channel_names:
             del channels_info[to_remove_channel_name]
 
+        # whitelist channels
+        if self._channel_whitelist is not None:
+            for channel_name in self._channel_whitelist:
+                if channel_name not in channels_info:
+                    logger.warning(f'Whitelisted channel not found: {channel_name}')
+            channels_info = {
+                channel_name: channel_info for channel_name, channel_info in channels_info.items()
+                if channel_name in self._channel_whitelist
+            }
+
         logger.info(f'Parsed channels: {", ".join(channels_info.keys())}')
 
         return channels_info
 
+    def _get_channel_specs(self) -> {str: EXRChannelSpec}:
+        return {channel_name: channel_info.finalize() for channel_name, channel_info in self._channels_info.items()}
+
+    def _get_header_channels(self) -> {str: dict}:
+        # output channel list of each separated file, the rest of the header comes from every frame itself
+        return {
+            channel_name: {c: channel_info.get_type() for c in channel_info.get_target_channels()}
+            for channel_name, channel_info in self._channels_info.items()
+        }
+
     def separate(self):
         logger.info('Start separation')
         start_time = perf_counter()
 
-        # add args
-        process_args = []
-        for exr_file in self._exr_files:
-            for channel_name in self._channels_info.keys():
-                process_args.append((self, exr_file, channel_name))
+        # make folders
+        for channel_name in self._channels_info.keys():
+            target_folder = self._folder_path.joinpath(channel_name)
+            logger.debug(f'Make folder: {target_folder}')
+            target_folder.mkdir(parents=True, exist_ok=True)
+
+        # add args, the shared context is sent once per worker by the initializer instead of per task
+        process_args = [(exr_file, self.get_target_exr_files(exr_file)) for exr_file in self._exr_files]
 
         # process
         total_count = len(process_args)
+        chunk_size = max(1, total_count // (os.cpu_count() * 4))
         self.set_window_title('title Start separate')
-        with ProcessPoolExecutor() as executor:
-            results = executor.map(self.save_channel, process_args)
+        with ProcessPoolExecutor(initializer=self.init_worker, initargs=(self.get_separate_context(), )) as executor:
+            results = executor.map(self.save_frame, process_args, chunksize=chunk_size)
             for i, result in enumerate(results):
-                stat, message = result
-                if stat is True:
-                    logger.info(message)
-                else:
-                    logger.error(message)
+                for stat, message in result:
+                    if stat is True:
+                        logger.debug(message)
+                    else:
+                        logger.error(message)
                 self.set_window_title(f'title Separate progress: {i + 1}/{total_count}')
         self.set_window_title('title Finish')
 
@@ -158,78 +221,145 @@ class EXRSequence:
         end_time = perf_counter()
         logger.info(f'Finish separation ({end_time - start_time:.02f}s)')
 
+    def get_separate_context(self) -> EXRSeparateContext:
+        return EXRSeparateContext(self._channel_specs, self._header_channels)
+
     @staticmethod
     def set_window_title(title_text: str):
         os.system(f'title {title_text}')
 
     @staticmethod
-    def append_channel_name_to_filename(file: Path, channel_name: str):
-        filename_chars = [char for char in file.stem]
-        frame_number = []
+    def split_frame_number(stem: str) -> (str, str):
+        # trailing non-alphabetic part of the stem, e.g. "shot_v01.0001" -> ("shot_v", "01.0001")
+        index = len(stem)
+        while index > 0 and not stem[index - 1].isalpha():
+            index -= 1
+        return stem[:index], stem[index:]
+
+    def get_target_exr_files(self, exr_file: Path) -> {str: Path}:
+        # the frame number only depends on the stem, split it once for all channels
+        name, frame_number = self.split_frame_number(exr_file.stem)
+        return {
+            channel_name: self._folder_path.joinpath(
+                channel_name, f'{name}.{channel_name}{frame_number}{exr_file.suffix}'
+            )
+            for channel_name in self._channels_info.keys()
+        }
 
-        while len(filename_chars) != 0:
-            if filename_chars[-1].isdecimal():
-                frame_number.insert(0, filename_chars.pop())
-                continue
-            break
+    @staticmethod
+    def clean_header(header: dict):
+        for to_remove_key in _HEADER_REMOVE_KEYS & header.keys():
+            del header[to_remove_key]
 
-        while len(filename_chars) != 0:
-            if not filename_chars[-1].isalpha():
-                frame_number.insert(0, filename_chars.pop())
+    @staticmethod
+    def read_labels_data(
+            context: EXRSeparateContext, source_exr: OpenEXR.InputFile, copy_channel_names: {str}
+    ) -> {str: bytes}:
+        # only the labels to separate, channel() raises IOError on broken frames where channels() aborts
+        labels_data = {}
+        for channel_name, channel_spec in context.channel_specs.items():
+            if channel_name in copy_channel_names:
                 continue
-            break
-
-        return f'{"".join(filename_chars)}.{channel_name}{"".join(frame_number)}{file.suffix}'
+            pixel_type = Imath.PixelType(channel_spec.pixel_type)
+            for label in channel_spec.labels:
+                labels_data[label] = source_exr.channel(label, pixel_type)
+        return labels_data
 
     @staticmethod
-    def clean_header(header: dict):
-        to_remove_keys = [
-            'image:crop', 'image:window', 'renderMemory', 'renderTime', 'space:world',
-            'worldToCamera', 'worldToNDC',
-            'order'
-        ]
-        for to_remove_key in to_remove_keys:
-            if to_remove_key in header:
-                del header[to_remove_key]
+    def get_frame_headers(context: EXRSeparateContext, frame_header: dict) -> {str: dict}:
+        base_header = dict(frame_header)
+        EXRSequence.clean_header(base_header)
+
+        headers = {}
+        for channel_name, header_channels in context.header_channels.items():
+            header = dict(base_header)
+            header['channels'] = header_channels
+            headers[channel_name] = header
+        return headers
 
     @staticmethod
-    def save_channel(arg) -> (bool, str):
-        exr_sequence: EXRSequence = arg[0]
-        exr_file: Path = arg[1]
-        channel_name: str = arg[2]
+    def get_frame_copy_channel_names(context: EXRSeparateContext, frame_header: dict) -> {str}:
+        # a color channel holding every label of this frame is already the whole file, copy instead of re-encode,
+        # unless the header has keys that every other output gets stripped of
+        if _HEADER_REMOVE_KEYS & frame_header.keys():
+            return frozenset()
+        frame_labels = set(frame_header['channels'].keys())
+        return frozenset(
+            channel_name for channel_name, channel_spec in context.channel_specs.items()
+            if channel_spec.is_color and set(channel_spec.labels) == frame_labels
+        )
 
-        if channel_name not in exr_sequence._channels_info.keys():
-            return False, f'No channel name "{channel_name}" found ({exr_sequence._channels_info})'
+    @staticmethod
+    def read_frame(context: EXRSeparateContext, exr_file: Path) -> ({str: dict}, {str}, {str: bytes}):
+        logger.debug('Source: {}', exr_file)
+        source_exr = OpenEXR.InputFile(str(exr_file))
+        try:
+            frame_header = source_exr.header()
+            headers = EXRSequence.get_frame_headers(context, frame_header)
+            copy_channel_names = EXRSequence.get_frame_copy_channel_names(context, frame_header)
+            labels_data = EXRSequence.read_labels_data(context, source_exr, copy_channel_names)
+            return headers, copy_channel_names, labels_data
+        finally:
+            # release decoder state even when decoding fails, workers live for the whole sequence
+            source_exr.close()
 
-        logger.debug(f'Process [{channel_name}]: {exr_file}')
+    @staticmethod
+    def init_worker(context: EXRSeparateContext):
+        global _worker_context
+        _worker_context = context
 
-        logger.debug(f'Source: {exr_file}')
-        source_exr = OpenEXR.InputFile(str(exr_file))
-        channel_info = exr_sequence._channels_info[channel_name]
+    @staticmethod
+    def save_frame(arg) -> [(bool, str)]:
+        context: EXRSeparateContext = _worker_context
+        exr_file: Path = arg[0]
+        target_exr_files: {str: Path} = arg[1]
+
+        # report a broken frame and keep separating the rest of the sequence
+        try:
+            headers, copy_channel_names, labels_data = EXRSequence.read_frame(context, exr_file)
+        except Exception as e:
+            return [(False, f'Read failed: {exr_file.stem} ({e})')]
+
+        try:
+            return EXRSequence.save_all_channels(
+                context, exr_file, target_exr_files, headers, copy_channel_names, labels_data
+            )
+        except Exception as e:
+            return [(False, f'Write failed: {exr_file.stem} ({e})')]
 
-        # make header
-        header = source_exr.header()
-        exr_sequence.clean_header(header)
+    @staticmethod
+    def save_all_channels(
+            context: EXRSeparateContext, exr_file: Path, target_exr_files: {str: Path},
+            headers: {str: dict}, copy_channel_names: {str}, labels_data: {str: bytes}
+    ) -> [(bool, str)]:
+        results = []
+        for channel_name, target_exr_file in target_exr_files.items():
+            if channel_name in copy_channel_names:
+                logger.debug('Copy file: {}', target_exr_file)
+                shutil.copyfile(exr_file, target_exr_file)
+                results.append((True, f'Copied: {exr_file.stem} [{channel_name}]'))
+                continue
+            results.append(EXRSequence.save_channel(
+                context, exr_file, channel_name, target_exr_file, headers[channel_name], labels_data
+            ))
 
-        header['channels'] = {}
-        for c in channel_info.get_target_channels():
-            header['channels'][c] = channel_info.get_type()
+        return results
 
-        # make folder
-        target_folder = exr_sequence._folder_path.joinpath(channel_name)
-        logger.debug(f'Make folder: {target_folder}')
-        target_folder.mkdir(parents=True, exist_ok=True)
-        target_exr_file = target_folder.joinpath(exr_sequence.append_channel_name_to_filename(exr_file, channel_name))
+    @staticmethod
+    def save_channel(
+            context: EXRSeparateContext, exr_file: Path, channel_name: str, target_exr_file: Path,
+            header: dict, labels_data: {str: bytes}
+    ) -> (bool, str):
+        logger.debug('Process [{}]: {}', channel_name, exr_file)
+        channel_spec = context.channel_specs[channel_name]
 
         # make exr
-        logger.debug(f'Write file: {target_exr_file}')
+        logger.debug('Write file: {}', target_exr_file)
         target_exr = OpenEXR.OutputFile(str(target_exr_file), header)
-        pixels_data = channel_info.get_pixels_data(source_exr)
+        pixels_data = channel_spec.get_pixels_data(labels_data)
         target_exr.writePixels(pixels_data)
-
         target_exr.close()
-        source_exr.close()
 
-        logger.debug(f'File saved: {str(target_exr_file)}')
+        logger.debug('File saved: {}', target_exr_file)
 
         return True, f'Separated: {exr_file.stem} [{channel_name}]'
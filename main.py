@@ -5,7 +5,7 @@ from loguru import logger
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
+    if len(sys.argv) < 2:
         logger.error(f'Arguments invalid: {sys.argv}')
         raise ValueError()
 
@@ -14,5 +14,7 @@ if __name__ == '__main__':
         logger.error(f'Folder invalid: {folder_path}')
         raise ValueError()
 
-    exr_seq = EXRSequence(folder_path)
+    channel_whitelist = sys.argv[2:] or None
+
+    exr_seq = EXRSequence(folder_path, channel_whitelist)
     exr_seq.separate()